@@ -5,7 +5,10 @@ __author__ = "Milo Bashford"
 
 import argparse
 import configparser
+import cProfile
 import datetime
+import hashlib
+import json
 import os
 import requests
 import schedule
@@ -13,9 +16,12 @@ import signal
 import sys
 import time
 import threading
+import traceback
+import tracemalloc
+import uuid
 
 from typing import Union
-from zabbix_utils import ZabbixAPI
+from zabbix_utils import APIRequestError, ProcessingError, ZabbixAPI
 
 
 # Only works with pzthon version 3.11 - 3.11.9
@@ -24,6 +30,7 @@ from zabbix_utils import ZabbixAPI
 # ---------
 # 1. Store templategroup, template and hostgroup IDs in Creator Context
 # 2. Propogate host deletion/update from remote api // not desired
+#   - opt-in stale host disable/delete only, see 'stale_host_cleanup'
 # 3. parent host creator with specific api implementations inheritinng core funcitonality
 # 4. Make hostgroup/template/templategroups creation not default behavior
 # 5. Add extra fieldss to host inventories
@@ -53,13 +60,26 @@ class OneWebHostCreator:
             "Resource_Inv": "https://api.oneweb.training/resourceInventory/v3"
         }
     }
+
+    # host macro recording when a stale host was disabled
+    disabled_macro = "{$ONEWEB.DISABLED.AT}"
     
 
-    def __init__(self, conf_path=None):
+    def __init__(self, conf_path=None, profile=False):
 
         self.__log_file = ".log"
         self.__log_path = ""
         self.__log_lock = threading.Lock()
+        self.__journal_file = ".journal"
+        self.__journal_path = ""
+
+        # held while importing hosts or reloading config
+        self.__run_lock = threading.Lock()
+        self.__reload_pending = False
+
+        # profile the next host import, toggled by SIGUSR1
+        self.__profile_next_run = profile
+        self.__profile_toggled = False
 
         # read config file
         self.__set_conf_path(conf_path)
@@ -70,6 +90,9 @@ class OneWebHostCreator:
 
         signal.signal(signal.SIGTERM, self.__exit)
         signal.signal(signal.SIGINT, self.__exit)
+        signal.signal(signal.SIGHUP, self.__request_reload)
+        signal.signal(signal.SIGUSR1, self.__toggle_profiling)
+        signal.signal(signal.SIGUSR2, self.__request_diagnostics)
         
     
     def __set_conf_path(self, conf_path):
@@ -91,7 +114,7 @@ class OneWebHostCreator:
 
     def __set_log_path(self, path):
 
-        default_path = self.__log_path
+        default_path = ""
         
         if path in [None, ""]:
             self.__log_path = default_path
@@ -107,6 +130,16 @@ class OneWebHostCreator:
             self.__log_path = default_path
 
 
+    def __set_journal_path(self, path):
+
+        if path in [None, ""]:
+            self.__journal_path = self.__journal_file
+        elif os.path.isdir(path):
+            self.__journal_path = os.path.join(path, self.__journal_file)
+        else:
+            self.__journal_path = path
+
+
     def __parse_config(self):
         try:
             if os.path.exists(self.__conf_file) == False:
@@ -123,22 +156,6 @@ class OneWebHostCreator:
             conf_file.read(self.__conf_file)
 
             log_path = conf_file.get("general", "log_path")
-            update_interval = conf_file.get("general", "update_interval")
-
-
-            oneweb_client_id = conf_file.get("oneweb", "client_id")
-            oneweb_client_secret = conf_file.get("oneweb", "client_secret")
-            oneweb_api_version = conf_file.get("oneweb", "api_version")
-
-            zabbix_username = conf_file.get("zabbix", "username")
-            zabbix_password = conf_file.get("zabbix", "password")
-            zabbix_server_ip = conf_file.get("zabbix", "server_ip")
-            zabbix_template_group = conf_file.get("zabbix", "template_group")
-            zabbix_template_group_create = conf_file.get("zabbix", "create_template_group_if_none")
-            zabbix_template = conf_file.get("zabbix", "template")
-            zabbix_template_create = conf_file.get("zabbix", "create_template_if_none")
-            zabbix_host_group = conf_file.get("zabbix", "host_group")
-            zabbix_host_group_create = conf_file.get("zabbix", "create_host_group_if_none")
 
             self.__set_log_path(log_path)
             self.__write_logs("----------------------\n" +
@@ -151,88 +168,252 @@ class OneWebHostCreator:
                 self.__write_logs(f"WARNING: Can't access {log_path}, logs will be generated in:\n" +
                                 f"{os.path.abspath(self.__log_path)}") 
 
-            # validate oneweb scraping interval - default to once every hour
-            if update_interval.isnumeric():
-                self.__update_interval = int(update_interval)
-            else:
-                self.__write_logs("WARNING: Can't parse update interval from config - defaulting to 3600 seconds")
-                self.__update_interval = 3600
+            self.__apply_config(self.__read_config(conf_file))
 
-            # oneweb client id
-            if oneweb_client_id != "":
-                self.__oneweb_client_id = oneweb_client_id
-            else:
-                self.__write_logs("FATALERROR: OneWeb Client ID must not be null")
-                self.__exit(status=1)
+        except Exception as e:
+            self.__write_logs(["FATALERROR: Unable to parse config file", str(e)])
+            self.__exit(status=1)
 
-            # oneweb client secret
-            if oneweb_client_secret != "":
-                self.__oneweb_client_secret = oneweb_client_secret
-            else:
-                self.__write_logs("FATALERROR: OneWeb Client Secret must not be null")
-                self.__exit(status=1)
 
-            # oneweb API version
-            if oneweb_api_version in self.urls.keys():
-                self.__oneweb_api_version = oneweb_api_version
-            else:
-                self.__write_logs(f"FATALERROR: OneWeb api version must be one of {self.urls.keys()}")
-                self.__exit(status=1)
+    def __read_config(self, conf_file, reload=False):
+        """Validate options from a parsed config file and return them as a dict,
+        raises an exception on the first invalid option. Defaults used for bad
+        values at startup are rejected when reloading"""
+
+        conf = {}
+
+        conf["log_path"] = conf_file.get("general", "log_path")
+        update_interval = conf_file.get("general", "update_interval")
+        conf["journal_path"] = conf_file.get("general", "journal_path", fallback="")
+
+        oneweb_client_id = conf_file.get("oneweb", "client_id")
+        oneweb_client_secret = conf_file.get("oneweb", "client_secret")
+        oneweb_api_version = conf_file.get("oneweb", "api_version")
+
+        zabbix_username = conf_file.get("zabbix", "username")
+        zabbix_password = conf_file.get("zabbix", "password")
+        zabbix_server_ip = conf_file.get("zabbix", "server_ip")
+        zabbix_template_group = conf_file.get("zabbix", "template_group")
+        zabbix_template_group_create = conf_file.get("zabbix", "create_template_group_if_none")
+        zabbix_template = conf_file.get("zabbix", "template")
+        zabbix_template_create = conf_file.get("zabbix", "create_template_if_none")
+        zabbix_host_group = conf_file.get("zabbix", "host_group")
+        zabbix_host_group_create = conf_file.get("zabbix", "create_host_group_if_none")
+        zabbix_host_page_size = conf_file.get("zabbix", "host_page_size", fallback="1000")
+        zabbix_stale_host_cleanup = conf_file.get("zabbix", "stale_host_cleanup", fallback="False")
+        zabbix_stale_host_max_age = conf_file.get("zabbix", "stale_host_max_age", fallback="30")
+        zabbix_stale_host_grace_period = conf_file.get("zabbix", "stale_host_grace_period", fallback="7")
+        zabbix_stale_host_max_changes = conf_file.get("zabbix", "stale_host_max_changes", fallback="50")
+        zabbix_stale_host_abort_percent = conf_file.get("zabbix", "stale_host_abort_percent", fallback="20")
+
+        # validate oneweb scraping interval - default to once every hour
+        if update_interval.isnumeric():
+            conf["update_interval"] = int(update_interval)
+        elif reload:
+            raise Exception(f"Can't parse update interval '{update_interval}'")
+        else:
+            self.__write_logs("WARNING: Can't parse update interval from config - defaulting to 3600 seconds")
+            conf["update_interval"] = 3600
 
-            if zabbix_username != "":
-                self.__zabbix_username = zabbix_username
-            else:
-                self.__write_logs("FATALERROR: Zabbix Username must not be null")
-                self.__exit(status=1)
+        # oneweb client id
+        if oneweb_client_id != "":
+            conf["oneweb_client_id"] = oneweb_client_id
+        else:
+            raise Exception("OneWeb Client ID must not be null")
 
-            if zabbix_password != "":
-                self.__zabbix_password = zabbix_password
-            else:
-                self.__write_logs("FATALERROR: Zabbix Password must not be null")
-                self.__exit(status=1)
+        # oneweb client secret
+        if oneweb_client_secret != "":
+            conf["oneweb_client_secret"] = oneweb_client_secret
+        else:
+            raise Exception("OneWeb Client Secret must not be null")
 
-            if zabbix_server_ip != "":
-                self.__zabbix_server_ip = zabbix_server_ip
-            else:
-                self.__write_logs("FATALERROR: Zabbix Server must not be null")
-                self.__exit(status=1)
+        # oneweb API version
+        if oneweb_api_version in self.urls.keys():
+            conf["oneweb_api_version"] = oneweb_api_version
+        else:
+            raise Exception(f"OneWeb api version must be one of {self.urls.keys()}")
 
-            if zabbix_template_group != "":
-                self.__zabbix_template_group = zabbix_template_group
-            else:
-                self.__write_logs(f"FATALERROR: Zabbix Template Group must not be empty")
-                self.__exit(status=1)
+        if zabbix_username != "":
+            conf["zabbix_username"] = zabbix_username
+        else:
+            raise Exception("Zabbix Username must not be null")
 
-            if zabbix_template != "":
-                self.__zabbix_template = zabbix_template
-            else:
-                self.__write_logs(f"FATALERROR: Zabbix Template must not be empty")
-                self.__exit(status=1)
-            
-            if zabbix_host_group != "":
-                self.__zabbix_host_group = zabbix_host_group
-            else:
-                self.__write_logs(f"FATALERROR: Zabbix Host Group must not be empty")
-                self.__exit(status=1)
+        if zabbix_password != "":
+            conf["zabbix_password"] = zabbix_password
+        else:
+            raise Exception("Zabbix Password must not be null")
 
-            if zabbix_host_group_create.lower() == "true":
-                self.__zabbix_host_group_create = True
-            else:
-                self.__zabbix_host_group_create = False
+        if zabbix_server_ip != "":
+            conf["zabbix_server_ip"] = zabbix_server_ip
+        else:
+            raise Exception("Zabbix Server must not be null")
 
-            if zabbix_template_group_create.lower() == "true":
-                self.__zabbix_template_group_create = True
-            else:
-                self.__zabbix_template_group_create = False
-            
-            if zabbix_template_create.lower() == "true":
-                self.__zabbix_template_create = True
-            else:
-                self.__zabbix_template_create = False
+        if zabbix_template_group != "":
+            conf["zabbix_template_group"] = zabbix_template_group
+        else:
+            raise Exception("Zabbix Template Group must not be empty")
 
-        except Exception as e:
-            self.__write_logs(["FATALERROR: Unable to parse config file", str(e)])
-            self.__exit(status=1)
+        if zabbix_template != "":
+            conf["zabbix_template"] = zabbix_template
+        else:
+            raise Exception("Zabbix Template must not be empty")
+        
+        if zabbix_host_group != "":
+            conf["zabbix_host_group"] = zabbix_host_group
+        else:
+            raise Exception("Zabbix Host Group must not be empty")
+
+        if zabbix_host_page_size.isnumeric() and int(zabbix_host_page_size) > 0:
+            conf["zabbix_host_page_size"] = int(zabbix_host_page_size)
+        else:
+            raise Exception("Zabbix Host Page Size must be a positive integer")
+
+        if zabbix_stale_host_max_age.isnumeric():
+            conf["zabbix_stale_host_max_age"] = int(zabbix_stale_host_max_age)
+        else:
+            raise Exception("Zabbix Stale Host Max Age must be a whole number of days")
+
+        if zabbix_stale_host_grace_period.isnumeric():
+            conf["zabbix_stale_host_grace_period"] = int(zabbix_stale_host_grace_period)
+        else:
+            raise Exception("Zabbix Stale Host Grace Period must be a whole number of days")
+
+        if zabbix_stale_host_max_changes.isnumeric():
+            conf["zabbix_stale_host_max_changes"] = int(zabbix_stale_host_max_changes)
+        else:
+            raise Exception("Zabbix Stale Host Max Changes must be a whole number")
+
+        if zabbix_stale_host_abort_percent.isnumeric() and int(zabbix_stale_host_abort_percent) <= 100:
+            conf["zabbix_stale_host_abort_percent"] = int(zabbix_stale_host_abort_percent)
+        else:
+            raise Exception("Zabbix Stale Host Abort Percent must be a whole number from 0 to 100")
+
+        conf["zabbix_stale_host_cleanup"] = zabbix_stale_host_cleanup.lower() == "true"
+        conf["zabbix_host_group_create"] = zabbix_host_group_create.lower() == "true"
+        conf["zabbix_template_group_create"] = zabbix_template_group_create.lower() == "true"
+        conf["zabbix_template_create"] = zabbix_template_create.lower() == "true"
+
+        return conf
+
+
+    def __apply_config(self, conf):
+        """Set running options from a validated config dict"""
+
+        self.__set_log_path(conf["log_path"])
+        self.__update_interval = conf["update_interval"]
+        self.__set_journal_path(conf["journal_path"])
+
+        self.__oneweb_client_id = conf["oneweb_client_id"]
+        self.__oneweb_client_secret = conf["oneweb_client_secret"]
+        self.__oneweb_api_version = conf["oneweb_api_version"]
+
+        self.__zabbix_username = conf["zabbix_username"]
+        self.__zabbix_password = conf["zabbix_password"]
+        self.__zabbix_server_ip = conf["zabbix_server_ip"]
+        self.__zabbix_template_group = conf["zabbix_template_group"]
+        self.__zabbix_template_group_create = conf["zabbix_template_group_create"]
+        self.__zabbix_template = conf["zabbix_template"]
+        self.__zabbix_template_create = conf["zabbix_template_create"]
+        self.__zabbix_host_group = conf["zabbix_host_group"]
+        self.__zabbix_host_group_create = conf["zabbix_host_group_create"]
+        self.__zabbix_host_page_size = conf["zabbix_host_page_size"]
+        self.__zabbix_stale_host_cleanup = conf["zabbix_stale_host_cleanup"]
+        self.__zabbix_stale_host_max_age = conf["zabbix_stale_host_max_age"]
+        self.__zabbix_stale_host_grace_period = conf["zabbix_stale_host_grace_period"]
+        self.__zabbix_stale_host_max_changes = conf["zabbix_stale_host_max_changes"]
+        self.__zabbix_stale_host_abort_percent = conf["zabbix_stale_host_abort_percent"]
+
+        self.__config = conf
+
+
+    def __request_reload(self, *args):
+        """SIGHUP handler, config is reloaded by the scheduler loop"""
+        self.__reload_pending = True
+
+
+    def __reload_config(self):
+        """Re-read the config file and apply it in place. Only components whose
+        settings have changed are rebuilt, an invalid config is rejected and the
+        previous config is kept running"""
+
+        self.__reload_pending = False
+        self.__write_logs(f"Reloading config from: {os.path.abspath(self.__conf_file)}")
+
+        # wait for any running host import to finish
+        with self.__run_lock:
+
+            old_conf = self.__config
+            old_zapi = self.__zapi
+
+            try:
+                if os.path.exists(self.__conf_file) == False:
+                    raise Exception(f"No config file found at {os.path.abspath(self.__conf_file)}")
+
+                conf_file = configparser.ConfigParser()
+                conf_file.read(self.__conf_file)
+                conf = self.__read_config(conf_file, reload=True)
+
+                changed = [k for k in conf.keys() if conf[k] != old_conf.get(k)]
+                if len(changed) == 0:
+                    self.__write_logs("... Config unchanged")
+                    return
+
+                if "update_interval" in changed and conf["update_interval"] == 0:
+                    raise Exception("update_interval can't be set to 0 while the built-in scheduler is running, " +
+                                    "restart Zabbix Host Creator for OneWeb to disable the scheduler")
+
+                self.__apply_config(conf)
+
+                # reconnect to zabbix only if the connection settings changed
+                reconnect = any(k in changed for k in [
+                    "zabbix_server_ip",
+                    "zabbix_username",
+                    "zabbix_password"])
+                if reconnect:
+                    self.__zapi = self.__connect_zabbix()
+
+                if any(k in changed for k in [
+                    "oneweb_client_id",
+                    "oneweb_client_secret",
+                    "oneweb_api_version"]):
+                    self.__test_oneweb_connection()
+                    self.__write_logs("WARNING: OneWeb settings changed, macros and items on an existing \n" +
+                                    f"template '{self.__zabbix_template}' are not updated")
+
+                if reconnect or any(k in changed for k in [
+                    "zabbix_template_group",
+                    "zabbix_template_group_create",
+                    "zabbix_template",
+                    "zabbix_template_create",
+                    "zabbix_host_group",
+                    "zabbix_host_group_create"]):
+                    self.__zabbix_template_group_exists()
+                    self.__zabbix_template_exists()
+                    self.__zabbix_host_group_exists()
+
+            except Exception as e:
+                # roll back to the previous config & connection
+                if self.__zapi is not old_zapi:
+                    try:
+                        self.__zapi.logout()
+                    except Exception:
+                        pass
+                self.__zapi = old_zapi
+                self.__apply_config(old_conf)
+
+                self.__write_logs(["WARNING: Config reload rejected, continuing with previous config", str(e)])
+                return
+
+            if self.__zapi is not old_zapi:
+                try:
+                    old_zapi.logout()
+                except Exception as e:
+                    self.__write_logs(["WARNING: Unable to log out of previous zabbix session", str(e)])
+
+            if "update_interval" in changed:
+                self.__schedule_host_creation()
+
+            self.__write_logs(f"... Config reloaded, changed options: {', '.join(changed)}")
 
 
     def __gen_config(self):
@@ -241,6 +422,7 @@ class OneWebHostCreator:
         conf_file.add_section("general")
         conf_file.set("general", "log_path", "")
         conf_file.set("general", "update_interval", "3600")
+        conf_file.set("general", "journal_path", "")
 
         conf_file.add_section("oneweb")
         conf_file.set("oneweb", "client_id", "myClientID")
@@ -257,6 +439,12 @@ class OneWebHostCreator:
         conf_file.set("zabbix", "create_template_group_if_none", "False")
         conf_file.set("zabbix", "create_template_if_none", "False")
         conf_file.set("zabbix", "create_host_group_if_none", "False")
+        conf_file.set("zabbix", "host_page_size", "1000")
+        conf_file.set("zabbix", "stale_host_cleanup", "False")
+        conf_file.set("zabbix", "stale_host_max_age", "30")
+        conf_file.set("zabbix", "stale_host_grace_period", "7")
+        conf_file.set("zabbix", "stale_host_max_changes", "50")
+        conf_file.set("zabbix", "stale_host_abort_percent", "20")
 
         with open(self.__conf_file, "w") as fp:
             conf_file.write(fp)
@@ -265,10 +453,16 @@ class OneWebHostCreator:
         self.__exit(0)
 
 
+    def __connect_zabbix(self):
+        """Create & log in to a new zabbix api session"""
+        zapi = ZabbixAPI(url=f"http://{self.__zabbix_server_ip}/zabbix/api_jsonrpc.php")
+        zapi.login(user=self.__zabbix_username, password=self.__zabbix_password)
+        return zapi
+
+
     def __init_zabbix_connection(self):
         try:
-            self.__zapi = ZabbixAPI(url=f"http://{self.__zabbix_server_ip}/zabbix/api_jsonrpc.php")
-            self.__zapi.login(user=self.__zabbix_username, password=self.__zabbix_password)
+            self.__zapi = self.__connect_zabbix()
         except Exception as e:
             self.__write_logs(["FATALERROR: Unable connect to zabbix server", str(e)])
             self.__exit(1)  
@@ -295,8 +489,7 @@ class OneWebHostCreator:
                 self.__write_logs("... Could not connect to OneWeb API")
                 raise Exception(f"{response.status_code} Error: {response.reason}")
         except Exception as e:
-            self.__write_logs(["FATALERROR: Unable to connect to OneWeb API", str(e)])
-            self.__exit(status=1)
+            raise Exception(f"Unable to connect to OneWeb API\n{str(e)}")
 
 
     def __get_oneweb_inventory(self):
@@ -329,8 +522,7 @@ class OneWebHostCreator:
                 raise Exception(f"{response.status_code} Error: {response.reason}")
                     
         except Exception as e:
-            self.__write_logs(["FATALERROR: Unable to get host data from OneWeb API", str(e)])
-            self.__exit(status=1)
+            raise Exception(f"Unable to get host data from OneWeb API\n{str(e)}")
 
 
     def __get_product_ids(self):
@@ -382,9 +574,7 @@ class OneWebHostCreator:
                 raise Exception(f"Duplicate Template Group Names")
             
         except Exception as e:
-            self.__write_logs([f"FATALERROR: {str(e)}"])
-            self.__zapi.logout()
-            self.__exit(status=1)       
+            raise Exception(f"Unable to verify Template Group '{self.__zabbix_template_group}'\n{str(e)}")
 
 
     def __get_zabbix_template(self):
@@ -517,8 +707,7 @@ class OneWebHostCreator:
                 raise Exception(f"Duplicate Template Names")
             
         except Exception as e:
-            self.__write_logs([f"FATALERROR: {str(e)}"])
-            self.__exit(status=1)  
+            raise Exception(f"Unable to verify Template '{self.__zabbix_template}'\n{str(e)}")
 
 
     def __get_zabbix_host_group(self):
@@ -562,9 +751,7 @@ class OneWebHostCreator:
                 raise Exception(f"Duplicate Host Group Names")
             
         except Exception as e:
-            self.__write_logs([f"FATALERROR: {str(e)}"])
-            self.__zapi.logout()
-            self.__exit(status=1)       
+            raise Exception(f"Unable to verify Host Group '{self.__zabbix_host_group}'\n{str(e)}")
 
 
     def __get_zabbix_host(self, name):
@@ -576,13 +763,39 @@ class OneWebHostCreator:
         })
 
 
+    def __iter_zabbix_hosts(self, output=("hostid", "host"), **params):
+        """Yield hosts in the configured host group a page at a time. The zabbix
+        api has no offset for host.get, so only host IDs are fetched for the whole
+        group and full hosts are then requested in pages by ID. Pass only the output
+        fields and select* subqueries needed, e.g. selectTags=["tag", "value"]"""
+        hostgroup = self.__get_zabbix_host_group()
+        if len(hostgroup) != 1:
+            raise Exception(f"Zabbix Host Group '{self.__zabbix_host_group}' does not exist or is not unique")
+
+        hostids = [host["hostid"] for host in self.__zapi.host.get({
+            "groupids": hostgroup[0]["groupid"],
+            "output": ["hostid"],
+            "sortfield": "hostid",
+        })]
+
+        page_size = self.__zabbix_host_page_size
+        for i in range(0, len(hostids), page_size):
+            page = self.__zapi.host.get({
+                **params,
+                "hostids": hostids[i:i + page_size],
+                "output": list(output),
+            })
+            yield from page
+
+
     def __create_zabbix_host(self, name, tags=[], macros=[], inventory={}):
-        """"""
+        """Create host if none with the same name exists, returns one of
+        'created', 'exists' or 'failed'"""
         try:
 
             if len(self.__get_zabbix_host(name)) != 0:
                 #raise Exception(f"Host with name '{name}' already exists")
-                return 0
+                return "exists"
             else:
                 # get hostgroup id
                 hostgroup = self.__get_zabbix_host_group()
@@ -605,13 +818,247 @@ class OneWebHostCreator:
                 # check that host is created
                 if len(self.__get_zabbix_host(name)) != 1:
                     self.__write_logs(f"Unable to create host '{name}'")
-                    return 0
+                    return "failed"
                 else:
-                    return 1
+                    return "created"
 
         except Exception as e:
-            self.__write_logs([f"FATALERROR: Unable create zabbix Host {name}", str(e)])
-            self.__exit(status=1)
+            raise Exception(f"Unable create zabbix Host {name}\n{str(e)}") from e
+
+
+    def __is_zabbix_connection_error(self, e):
+        """True if an exception, or the exception it was raised from, is a
+        transport or session error after which no zabbix request can succeed"""
+        for err in [e, e.__cause__]:
+            if isinstance(err, ProcessingError):
+                return True
+            if isinstance(err, APIRequestError) and any(msg in str(err).lower() for msg in [
+                "session terminated",
+                "re-login",
+                "not authorized",
+                "not authorised"]):
+                return True
+        return False
+
+
+    def __parse_timestamp(self, value):
+        """Parse an ISO 8601 timestamp as UTC, returns None if unparseable"""
+        try:
+            ts = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except (AttributeError, ValueError):
+            return None
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=datetime.timezone.utc)
+        return ts
+
+
+    def __is_stale_terminal(self, terminal, now):
+        """A terminal is stale if missing from the inventory or not seen within
+        stale_host_max_age days, a max age of 0 only checks the inventory"""
+        if terminal is None:
+            return True
+        if self.__zabbix_stale_host_max_age == 0:
+            return False
+
+        last_seen = self.__parse_timestamp(terminal.get("lastSeenDate"))
+        if last_seen is None:
+            return False
+        return now - last_seen > datetime.timedelta(days=self.__zabbix_stale_host_max_age)
+
+
+    def __cleanup_stale_hosts(self, run_id):
+        """Disable hosts in the host group whose terminal is stale and delete them
+        once disabled for longer than the grace period. Hosts whose terminal has
+        returned are re-enabled. Only hosts with an IMEI tag are managed"""
+
+        self.__write_logs("Checking for stale hosts...")
+
+        if len(self.__oneweb_hosts) == 0:
+            self.__write_logs("WARNING: OneWeb inventory is empty, skipping stale host cleanup")
+            return
+
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            grace_period = datetime.timedelta(days=self.__zabbix_stale_host_grace_period)
+            terminals = {host["imei"]: host for host in self.__oneweb_hosts if "imei" in host}
+
+            managed = 0
+            to_disable, to_delete, to_enable = [], [], []
+            for host in self.__iter_zabbix_hosts(
+                output=["hostid", "host", "status"],
+                selectTags=["tag", "value"],
+                selectMacros=["macro", "value"]):
+
+                imei = next((t["value"] for t in host["tags"] if t["tag"] == "IMEI"), None)
+                if imei is None:
+                    continue
+
+                managed += 1
+                disabled_at = next((m["value"] for m in host["macros"] if m["macro"] == self.disabled_macro), None)
+
+                if self.__is_stale_terminal(terminals.get(imei), now):
+                    if host["status"] == "0":
+                        to_disable.append(host)
+                    elif disabled_at is not None:
+                        ts = self.__parse_timestamp(disabled_at)
+                        if ts is not None and now - ts >= grace_period:
+                            to_delete.append(host)
+                elif disabled_at is not None:
+                    to_enable.append(host)
+
+            # checked before any changes, a large share of hosts changing state at
+            # once points to a bad inventory rather than real decommissions.
+            # Pending deletes are left out as they were disabled runs ago
+            flips = len(to_enable) + len(to_disable)
+            if flips * 100 > managed * self.__zabbix_stale_host_abort_percent:
+                self.__write_logs(f"WARNING: {len(to_enable)} hosts to re-enable and {len(to_disable)} to disable out of {managed} \n" +
+                                f"exceeds stale_host_abort_percent ({self.__zabbix_stale_host_abort_percent}%), the OneWeb inventory may be \n" +
+                                "incomplete. Skipping stale host cleanup, raise stale_host_abort_percent if this is expected")
+                return
+
+            # process at most max_changes hosts per run, deletes first so the
+            # backlog of disabled hosts always drains, the rest are deferred
+            budget = self.__zabbix_stale_host_max_changes
+            to_delete = to_delete[:budget]
+            to_disable = to_disable[:budget - len(to_delete)]
+            to_enable = to_enable[:budget - len(to_delete) - len(to_disable)]
+            deferred = flips + len(to_delete) - budget if flips + len(to_delete) > budget else 0
+
+            for batch in self.__batches(to_delete):
+                self.__zapi.host.delete(*[host["hostid"] for host in batch])
+                self.__write_journal({"run": run_id, "event": "delete", "hosts": [host["host"] for host in batch]})
+
+            for batch in self.__batches(to_disable):
+                hostids = [host["hostid"] for host in batch]
+                # hosts re-enabled by hand keep an old macro, replace it
+                rearmed = [host["hostid"] for host in batch if any(m["macro"] == self.disabled_macro for m in host["macros"])]
+                if len(rearmed) != 0:
+                    self.__zapi.host.massremove({"hostids": rearmed, "macros": [self.disabled_macro]})
+
+                self.__zapi.host.massupdate({
+                    "hosts": [{"hostid": hostid} for hostid in hostids],
+                    "status": 1,
+                })
+                self.__zapi.host.massadd({
+                    "hosts": [{"hostid": hostid} for hostid in hostids],
+                    "macros": [{"macro": self.disabled_macro, "value": now.isoformat(timespec="seconds")}],
+                })
+                self.__write_journal({"run": run_id, "event": "disable", "hosts": [host["host"] for host in batch]})
+
+            for batch in self.__batches(to_enable):
+                hostids = [host["hostid"] for host in batch]
+                self.__zapi.host.massupdate({
+                    "hosts": [{"hostid": hostid} for hostid in hostids],
+                    "status": 0,
+                })
+                self.__zapi.host.massremove({"hostids": hostids, "macros": [self.disabled_macro]})
+                self.__write_journal({"run": run_id, "event": "enable", "hosts": [host["host"] for host in batch]})
+
+            self.__write_logs(f"Stale host cleanup completed: {len(to_delete)} deleted, " +
+                            f"{len(to_disable)} disabled, {len(to_enable)} re-enabled, " +
+                            f"{deferred} deferred to later runs by stale_host_max_changes.")
+
+        except Exception as e:
+            self.__write_logs(["WARNING: Stale host cleanup failed", str(e)])
+
+
+    def __batches(self, items):
+        """Split a list into batches of host_page_size"""
+        size = self.__zabbix_host_page_size
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+    def __get_inventory_digest(self):
+        """Digest of the terminals in the current inventory. Only names & IMEIs are
+        used as state such as lastSeenDate changes between every request"""
+        terminals = sorted(f"{host.get('imei')}:{host.get('name')}" for host in self.__oneweb_hosts)
+        return hashlib.sha256("\n".join(terminals).encode()).hexdigest()
+
+
+    def __get_unfinished_run(self, digest):
+        """Find the last run in the journal, if it did not finish and was started
+        from the same inventory return its ID and the set of IMEIs it completed.
+        Reading starts from the checkpointed offset of the last run's start entry"""
+        run_id = None
+        run_digest = None
+        completed = set()
+
+        if not os.path.exists(self.__journal_path):
+            return None, completed
+
+        try:
+            with open(self.__journal_path, "rb") as file:
+                file.seek(self.__read_journal_checkpoint(file))
+
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # partially written line from a crash
+                        continue
+
+                    if entry.get("event") == "start":
+                        run_id = entry["run"]
+                        run_digest = entry["digest"]
+                        completed = set()
+                    elif entry.get("run") != run_id:
+                        continue
+                    elif entry["event"] == "host" and entry["result"] != "failed":
+                        completed.add(entry["imei"])
+                    elif entry["event"] == "end":
+                        run_id = None
+
+        except Exception as e:
+            self.__write_logs(["WARNING: Unable to read journal, starting a new run", str(e)])
+            return None, set()
+
+        if run_id is None or run_digest != digest:
+            return None, set()
+
+        return run_id, completed
+
+
+    def __read_journal_checkpoint(self, file):
+        """Return the checkpointed offset of the last start entry in the journal,
+        or 0 if the checkpoint is missing or doesn't point at a start entry"""
+        try:
+            with open(self.__journal_path + ".checkpoint", "r") as cp:
+                offset = int(cp.read().strip())
+
+            file.seek(offset)
+            if json.loads(file.readline()).get("event") == "start":
+                return offset
+        except Exception:
+            pass
+
+        return 0
+
+
+    def __write_journal_checkpoint(self, offset):
+        """Record the offset of the current run's start entry in the journal"""
+        try:
+            cp_path = self.__journal_path + ".checkpoint"
+            with open(cp_path + ".tmp", "w") as cp:
+                cp.write(str(offset))
+            os.replace(cp_path + ".tmp", cp_path)
+
+        except Exception as e:
+            self.__write_logs(["WARNING: Unable to write journal checkpoint", str(e)])
+
+
+    def __write_journal(self, entry: dict):
+        """Append an entry to the run journal, returns the offset it was
+        written at or None on failure"""
+        try:
+            entry["ts"] = datetime.datetime.now().isoformat(timespec="seconds")
+            with open(self.__journal_path, "ab") as file:
+                offset = file.tell()
+                file.write(json.dumps(entry, separators=(",", ":")).encode() + b"\n")
+            return offset
+
+        except Exception as e:
+            self.__write_logs(["WARNING: Unable to write to journal", str(e)])
+            return None
 
 
     def __write_logs(self, entry: Union[str, list]):
@@ -641,36 +1088,186 @@ class OneWebHostCreator:
     
     def __create_hosts_from_oneweb(self):
 
+        # don't run alongside a config reload
+        with self.__run_lock:
+            self.__log_profiling_state()
+            if self.__profile_next_run:
+                self.__profile_next_run = False
+                return self.__profile_import_hosts()
+            else:
+                return self.__import_hosts()
+
+
+    def __profile_import_hosts(self):
+        """Run host import under cProfile and write stats next to the log file"""
+        log_dir = os.path.dirname(os.path.abspath(os.path.join(self.__log_path, self.__log_file)))
+        ts = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        stats_path = os.path.join(log_dir, f"zabbixHostCreator-{ts}.pstats")
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(self.__import_hosts)
+        finally:
+            try:
+                profiler.dump_stats(stats_path)
+                self.__write_logs(f"Host import profile written to: {stats_path}")
+            except Exception as e:
+                self.__write_logs(["WARNING: Unable to write host import profile", str(e)])
+
+
+    def __toggle_profiling(self, *args):
+        """SIGUSR1 handler, toggles profiling of the next host import. The new
+        state is logged outside the handler as logging here could deadlock"""
+        self.__profile_next_run = not self.__profile_next_run
+        self.__profile_toggled = True
+
+
+    def __log_profiling_state(self):
+        """Log whether profiling is armed if it has been toggled since last checked"""
+        if self.__profile_toggled:
+            self.__profile_toggled = False
+            if self.__profile_next_run:
+                self.__write_logs("Profiling armed for the next host import")
+            else:
+                self.__write_logs("Profiling disarmed")
+
+
+    def __request_diagnostics(self, *args):
+        """SIGUSR2 handler, diagnostics are written from a new thread as the
+        interrupted thread may be holding the log lock"""
+        threading.Thread(target=self.__write_diagnostics, daemon=True).start()
+
+
+    def __write_diagnostics(self, top_n=10):
+        """Log the current stack of every thread & a tracemalloc snapshot"""
+        names = {t.ident: t.name for t in threading.enumerate()}
+        entry = ["Diagnostics requested", "Thread stacks:"]
+
+        for ident, frame in sys._current_frames().items():
+            if ident == threading.get_ident():
+                continue
+            entry.append(f"--- {names.get(ident, 'unknown')} ({ident}) ---")
+            for block in traceback.format_stack(frame):
+                entry.extend(block.rstrip().splitlines())
+
+        # tracing slows every allocation, so it only runs between two requests
+        if tracemalloc.is_tracing():
+            entry.append(f"Top {top_n} memory allocations since tracemalloc was started:")
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+            tracemalloc.stop()
+            entry.extend(str(stat) for stat in stats[:top_n])
+            entry.append("tracemalloc stopped")
+        else:
+            tracemalloc.start()
+            entry.append("tracemalloc started, send SIGUSR2 again for a memory snapshot and to stop tracing")
+
+        self.__write_logs(entry)
+
+
+    def __import_hosts(self):
+
         self.__write_logs("Starting host import...")
 
         # Get OneWeb Hosts
-        self.__get_oneweb_inventory()
+        try:
+            self.__get_oneweb_inventory()
+        except Exception as e:
+            self.__write_logs(["ERROR: Skipping host import", str(e)])
+            self.__oneweb_hosts = []
+            return False
+
+        # Names of hosts already in the host group, these are skipped
+        # without querying zabbix for each host
+        try:
+            existing = {host["name"] for host in self.__iter_zabbix_hosts(output=["name"])}
+        except Exception as e:
+            self.__write_logs(["ERROR: Unable to read hosts from Zabbix, skipping host import", str(e)])
+            self.__oneweb_hosts = []
+            return False
+
+        # Start a new run or resume an unfinished one from the journal
+        digest = self.__get_inventory_digest()
+        run_id, completed = self.__get_unfinished_run(digest)
+
+        if run_id is None:
+            run_id = uuid.uuid4().hex
+            offset = self.__write_journal({"run": run_id, "event": "start", "digest": digest, "hosts": len(self.__oneweb_hosts)})
+            if offset is not None:
+                self.__write_journal_checkpoint(offset)
+        else:
+            self.__write_logs(f"Resuming unfinished run {run_id}: skipping {len(completed)} completed hosts")
+            self.__write_journal({"run": run_id, "event": "resume", "skipped": len(completed)})
 
-        # Make Hosts
+        # Make Hosts, only changes are journaled & existing hosts are counted
         created_hosts = 0
+        existing_hosts = 0
+        failed_hosts = 0
         for host in self.__oneweb_hosts:
-            created_hosts += self.__create_zabbix_host(
-                name=host["name"],
-                tags=[
-                    {"tag": "IMEI", "value": host["imei"]},
-                    {"tag": "IMSI", "value": host["imsi"]},
-                ],
-                macros=[
-                    {"macro": "{$REMOTE.IMEI}", "value": host["imei"]},
-                ],
-                inventory={
-                    "type": host["place"]["externalId"],
-                    "serialno_a": host["serialNumber"],
-                    "location_lat": host["location"]["features"][0]["geometry"]["coordinates"][0],
-                    "location_lon": host["location"]["features"][0]["geometry"]["coordinates"][1],
-                }
-            )
+            if host.get("imei") in completed:
+                continue
+
+            if host.get("name") in existing:
+                existing_hosts += 1
+                continue
+
+            try:
+                result = self.__create_zabbix_host(
+                    name=host["name"],
+                    tags=[
+                        {"tag": "IMEI", "value": host["imei"]},
+                        {"tag": "IMSI", "value": host["imsi"]},
+                    ],
+                    macros=[
+                        {"macro": "{$REMOTE.IMEI}", "value": host["imei"]},
+                    ],
+                    inventory={
+                        "type": host["place"]["externalId"],
+                        "serialno_a": host["serialNumber"],
+                        "location_lat": host["location"]["features"][0]["geometry"]["coordinates"][0],
+                        "location_lon": host["location"]["features"][0]["geometry"]["coordinates"][1],
+                    }
+                )
+            except Exception as e:
+                self.__write_journal({"run": run_id, "event": "host", "imei": host.get("imei"), "result": "failed", "error": str(e)})
+
+                # a bad inventory record only fails that terminal, but if zabbix
+                # can't be reached leave the run unfinished for the next import
+                if self.__is_zabbix_connection_error(e):
+                    self.__write_logs([f"ERROR: Host import aborted, run {run_id} will resume on next import", str(e)])
+                    self.__oneweb_hosts = []
+                    return False
+
+                self.__write_logs([f"ERROR: Unable to create host for terminal {host.get('imei')}", str(e)])
+                failed_hosts += 1
+                continue
+
+            if result == "exists":
+                existing_hosts += 1
+                continue
+
+            self.__write_journal({"run": run_id, "event": "host", "imei": host["imei"], "result": result})
+            if result == "created":
+                created_hosts += 1
+            else:
+                failed_hosts += 1
+
+        if self.__zabbix_stale_host_cleanup:
+            self.__cleanup_stale_hosts(run_id)
 
-        self.__write_logs(f"Host import completed: {created_hosts} new zabbix hosts created.")
+        self.__write_journal({"run": run_id, "event": "end", "created": created_hosts, "exists": existing_hosts, "failed": failed_hosts})
+        self.__write_logs(f"Host import completed: {created_hosts} new zabbix hosts created, {failed_hosts} failed.")
 
         # flush hosts after creation
         self.__oneweb_hosts = []
 
+        return failed_hosts == 0
+
+
+    def __schedule_host_creation(self):
+        """(Re)schedule host creation at the current update interval"""
+        schedule.clear()
+        schedule.every(self.__update_interval).seconds.do(lambda func: threading.Thread(target=func).start(), self.__create_hosts_from_oneweb)
+
         
     def __exit(self, status=0, *args):
         try:
@@ -715,13 +1312,17 @@ class OneWebHostCreator:
                             f"CLIENT SECRET: {self.__oneweb_client_secret}\n" +
                             f"VERSION: {self.__oneweb_api_version}")
             
-            # run now
-            self.__create_hosts_from_oneweb()
+            # run now, a failed one-shot run exits with an error status
+            if not self.__create_hosts_from_oneweb() and self.__update_interval == 0:
+                self.__exit(status=1)
 
             # set up scheduling...
             if self.__update_interval > 0:
-                schedule.every(self.__update_interval).seconds.do(lambda func: threading.Thread(target=func).start(), self.__create_hosts_from_oneweb)
+                self.__schedule_host_creation()
                 while True:
+                    self.__log_profiling_state()
+                    if self.__reload_pending:
+                        self.__reload_config()
                     schedule.run_pending()
                     time.sleep(1)
             else:
@@ -737,8 +1338,9 @@ if __name__ == "__main__":
     # get passed args
     psr = argparse.ArgumentParser()
     psr.add_argument("-c", "--conf-path", type=str)
+    psr.add_argument("-p", "--profile", action="store_true", help="profile the first host import")
     args = psr.parse_args()
 
-    cr = OneWebHostCreator(conf_path=args.conf_path)
+    cr = OneWebHostCreator(conf_path=args.conf_path, profile=args.profile)
     cr.main()
 